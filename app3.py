@@ -1,26 +1,33 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
-from openpyxl.utils.dataframe import dataframe_to_rows
+import xlsxwriter
 import plotly.graph_objects as go
 
-# Configuração da página
-st.set_page_config(page_title="Análise de Estoque", layout="wide")
-st.title("📈 Análise de Cobertura de Estoque")
 
-uploaded_file = st.file_uploader("Carregue seu arquivo Excel (análise.xlsx)", type=["xlsx"])
+# Formatos do relatório; cada um vira um único Format do xlsxwriter por workbook
+FORMATO_TITULO = {"bold": True}
+FORMATO_CORPO = {"border": 1, "align": "center", "valign": "vcenter"}
+FORMATO_CABECALHO = {**FORMATO_CORPO, "bold": True, "font_color": "#FFFFFF", "bg_color": "#0070C0"}
 
-if uploaded_file:
-    df = pd.read_excel(uploaded_file)
+# Faixas de cobertura: limites inferiores (inclusivos) de cada faixa a partir da segunda
+LIMITES_FAIXAS = np.array([0, 15, 30, 45, 60], dtype=np.float64)
+FAIXAS = ["<=0 dias", "1-15 dias", "16-30 dias", "31-45 dias", "46-60 dias", "Mais de 60 dias"]
 
-    required_cols = ["Filial", "Cobertura Atual", "Vlr Estoque Tmk", "Mercadoria", "Saldo Pedido"]
-    if not all(col in df.columns for col in required_cols):
-        missing_cols = [col for col in required_cols if col not in df.columns]
-        st.error(f"⚠ Arquivo inválido! Faltam as colunas: {', '.join(missing_cols)}")
-        st.stop()
+COLUNAS_OBRIGATORIAS = ["Filial", "Cobertura Atual", "Vlr Estoque Tmk", "Mercadoria", "Saldo Pedido"]
+
+
+@st.cache_data
+def carregar_planilha(conteudo):
+    # Uma única leitura; colunas ausentes não geram erro aqui e são validadas pelo chamador
+    return pd.read_excel(BytesIO(conteudo), usecols=lambda col: col in COLUNAS_OBRIGATORIAS, engine="calamine")
+
+
+@st.cache_data
+def analisar_estoque(conteudo):
+    df = carregar_planilha(conteudo)
 
     df = df.rename(columns={
         "Filial": "filial",
@@ -29,45 +36,141 @@ if uploaded_file:
         "Saldo Pedido": "saldo_pedido"
     })
 
-    saldo_totais = df.groupby("filial")["saldo_pedido"].sum()
-
-    def calcular_media_ponderada(grupo):
-        grupo = grupo[grupo["valor_estoque"] > 0]
-        if grupo.empty:
-            return 0
-        return np.average(grupo["cobertura_dias"], weights=grupo["valor_estoque"])
-
-    def calcular_media_simples(grupo):
-        return grupo["cobertura_dias"].mean()
-
-    cobertura = (
-        df.groupby("filial")
-        .apply(lambda grupo: pd.Series({
-            "Cobertura Média Ponderada (dias)": calcular_media_ponderada(grupo),
-            "Cobertura Média Simples (dias)": calcular_media_simples(grupo)
-        }))
-        .round(2)
-        .reset_index()
-        .rename(columns={"filial": "Filial"})
-    )
+    # Filial como categoria (somas por código inteiro); as colunas numéricas ficam em float64:
+    # em float32 uma cobertura como 14.9999999 vira 15.0 e muda de faixa
+    df = df.dropna(subset=["filial"]).astype({"filial": "category"})
 
-    cobertura["Saldo Pedido Total"] = cobertura["Filial"].map(saldo_totais)
+    # Colunas numéricas extraídas uma única vez como arrays contíguos e reusadas nas contas abaixo
+    cobertura_dias = np.ascontiguousarray(df["cobertura_dias"].to_numpy(np.float64))
+    valor_estoque = np.ascontiguousarray(df["valor_estoque"].to_numpy(np.float64))
+    saldo_pedido = np.ascontiguousarray(df["saldo_pedido"].to_numpy(np.float64))
+    cobertura_valida = ~np.isnan(cobertura_dias)
 
-    df['faixa'] = pd.cut(
-        df['cobertura_dias'],
-        bins=[-np.inf, 0, 15, 30, 45, 60, np.inf],
-        labels=["<=0 dias", "1-15 dias", "16-30 dias", "31-45 dias", "46-60 dias", "Mais de 60 dias"],
-        right=False
+    codigos_filial = df["filial"].cat.codes.to_numpy()
+    filiais = df["filial"].cat.categories
+    n_filiais = len(filiais)
+    valor_positivo = np.where(cobertura_valida & (valor_estoque > 0), valor_estoque, 0.0)
+
+    peso = np.bincount(codigos_filial, weights=valor_positivo, minlength=n_filiais)
+    cobertura_ponderada = np.bincount(
+        codigos_filial, weights=np.where(cobertura_valida, cobertura_dias * valor_positivo, 0.0), minlength=n_filiais
     )
+    soma_cobertura = np.bincount(codigos_filial, weights=np.where(cobertura_valida, cobertura_dias, 0.0), minlength=n_filiais)
+    qtd_cobertura = np.bincount(codigos_filial, weights=cobertura_valida, minlength=n_filiais)
+    saldo = np.bincount(codigos_filial, weights=np.where(np.isnan(saldo_pedido), 0.0, saldo_pedido), minlength=n_filiais)
+
+    cobertura = pd.DataFrame({
+        "Filial": filiais,
+        "Cobertura Média Ponderada (dias)": np.divide(
+            cobertura_ponderada, peso, out=np.zeros(n_filiais), where=peso > 0
+        ),
+        "Cobertura Média Simples (dias)": np.divide(
+            soma_cobertura, qtd_cobertura, out=np.full(n_filiais, np.nan), where=qtd_cobertura > 0
+        )
+    }).round(2)
+
+    cobertura["Saldo Pedido Total"] = saldo
 
-    resumo_valores = df.groupby(['filial', 'faixa'])['saldo_pedido'].sum().unstack().fillna(0)
-    resumo_valores['TOTAL'] = resumo_valores.sum(axis=1)
+    # searchsorted com side='right' reproduz os intervalos fechados à esquerda [a, b)
+    codigos = np.searchsorted(LIMITES_FAIXAS, cobertura_dias, side='right')
+    codigos[~cobertura_valida] = -1
+    df['faixa'] = pd.Categorical.from_codes(codigos, categories=FAIXAS, ordered=True)
+
+    # observed=True evita o produto cartesiano filial x faixa; o reindex mantém todas as faixas no relatório
+    resumo_valores = df.pivot_table(
+        index='filial', columns='faixa', values='saldo_pedido',
+        aggfunc='sum', fill_value=0, observed=True
+    ).reindex(columns=FAIXAS, fill_value=0.0)
+
+    # A mesma matriz de faixas serve para o TOTAL e para os percentuais
+    valores = resumo_valores.to_numpy(dtype=np.float64)
+    totais = valores.sum(axis=1)[:, None]
+    resumo_valores['TOTAL'] = totais[:, 0]
     resumo_valores = resumo_valores.reset_index()
 
-    resumo_percentuais = resumo_valores.copy()
-    for col in resumo_percentuais.columns[1:-1]:
-        resumo_percentuais[col] = (resumo_percentuais[col] / resumo_percentuais['TOTAL'] * 100).round(2)
-    resumo_percentuais = resumo_percentuais.drop(columns=['TOTAL'])
+    # Todas as faixas de uma vez; filiais com TOTAL zero ficam com 0%
+    percentuais = np.divide(valores, totais, out=np.zeros_like(valores), where=totais != 0) * 100
+    resumo_percentuais = pd.DataFrame(percentuais.round(2), columns=resumo_valores.columns[1:-1])
+    resumo_percentuais.insert(0, 'filial', resumo_valores['filial'])
+
+    return cobertura, resumo_valores, resumo_percentuais
+
+
+# Cache por filial: trocar a seleção no Pareto só reordena a linha já calculada
+@st.cache_data(show_spinner=False)
+def montar_pareto(resumo_percentuais, filial):
+    df_filial = resumo_percentuais[resumo_percentuais['filial'] == filial].drop(columns='filial').T
+    df_filial.columns = ['percentual']
+    df_filial = df_filial.sort_values(by='percentual', ascending=False)
+    df_filial['acumulado'] = df_filial['percentual'].cumsum()
+    # Os percentuais já somam 100; só reescala se o arredondamento deixou um desvio visível
+    total = df_filial['percentual'].sum()
+    if total and abs(total - 100) > 0.01:
+        df_filial['acumulado'] *= 100 / total
+    return df_filial
+
+
+def escrever_tabela_com_estilo(ws, df, titulo, linha_inicial, formatos):
+    # Linhas e colunas do xlsxwriter começam em 0
+    ws.merge_range(linha_inicial, 0, linha_inicial, df.shape[1] - 1, titulo, formatos["titulo"])
+    linha = linha_inicial + 1
+
+    ws.write_row(linha, 0, df.columns, formatos["cabecalho"])
+    # NaN (ex.: filial sem cobertura válida) vira célula em branco, mantendo a borda
+    for r_idx, row in enumerate(df.itertuples(index=False, name=None), start=linha + 1):
+        ws.write_row(r_idx, 0, [None if pd.isna(v) else v for v in row], formatos["corpo"])
+
+    return linha + len(df) + 1
+
+
+def gerar_relatorio_excel(cobertura, resumo_valores, resumo_percentuais):
+    output = BytesIO()
+    wb = xlsxwriter.Workbook(output, {"in_memory": True})
+    ws = wb.add_worksheet("Relatório Consolidado")
+    formatos = {
+        "titulo": wb.add_format(FORMATO_TITULO),
+        "cabecalho": wb.add_format(FORMATO_CABECALHO),
+        "corpo": wb.add_format(FORMATO_CORPO)
+    }
+
+    linha_atual = 0
+    linha_atual = escrever_tabela_com_estilo(ws, cobertura, "Cobertura Média por Filial", linha_atual, formatos)
+    linha_atual = escrever_tabela_com_estilo(ws, resumo_valores, "Distribuição por Faixa (Valores Absolutos)", linha_atual, formatos)
+    linha_atual = escrever_tabela_com_estilo(ws, resumo_percentuais, "Distribuição por Faixa (Percentuais)", linha_atual, formatos)
+
+    wb.close()
+    return output.getvalue()
+
+
+# O relatório é gerado em segundo plano enquanto as tabelas são exibidas. cache_resource
+# devolve sempre o mesmo Future (e os mesmos bytes); cache_data copiaria o arquivo a cada rerun.
+# max_entries limita quantos relatórios ficam em memória
+@st.cache_resource(max_entries=5)
+def iniciar_relatorio_excel(cobertura, resumo_valores, resumo_percentuais):
+    executor = ThreadPoolExecutor(max_workers=1)
+    futuro = executor.submit(gerar_relatorio_excel, cobertura, resumo_valores, resumo_percentuais)
+    executor.shutdown(wait=False)
+    return futuro
+
+
+# Configuração da página
+st.set_page_config(page_title="Análise de Estoque", layout="wide")
+st.title("📈 Análise de Cobertura de Estoque")
+
+uploaded_file = st.file_uploader("Carregue seu arquivo Excel (análise.xlsx)", type=["xlsx"])
+
+if uploaded_file:
+    # Conteúdo do arquivo é a chave do cache: trocar a filial do Pareto não relê o Excel
+    conteudo = uploaded_file.getvalue()
+    colunas = carregar_planilha(conteudo).columns
+
+    if not all(col in colunas for col in COLUNAS_OBRIGATORIAS):
+        missing_cols = [col for col in COLUNAS_OBRIGATORIAS if col not in colunas]
+        st.error(f"⚠ Arquivo inválido! Faltam as colunas: {', '.join(missing_cols)}")
+        st.stop()
+
+    cobertura, resumo_valores, resumo_percentuais = analisar_estoque(conteudo)
+    relatorio_excel = iniciar_relatorio_excel(cobertura, resumo_valores, resumo_percentuais)
 
     # Exibição no Streamlit
     st.subheader("📌 Cobertura Média por Filial")
@@ -84,11 +187,7 @@ if uploaded_file:
     filiais = resumo_percentuais['filial'].unique()
     filial_selecionada = st.selectbox("Selecione a Filial para o Gráfico de Pareto", filiais)
 
-    df_filial = resumo_percentuais[resumo_percentuais['filial'] == filial_selecionada].drop(columns='filial').T
-    df_filial.columns = ['percentual']
-    df_filial = df_filial.sort_values(by='percentual', ascending=False)
-    df_filial['acumulado'] = df_filial['percentual'].cumsum()
-    df_filial['acumulado_perc'] = (df_filial['acumulado'] / df_filial['percentual'].sum()) * 100
+    df_filial = montar_pareto(resumo_percentuais, filial_selecionada)
 
     fig = go.Figure()
 
@@ -101,7 +200,7 @@ if uploaded_file:
 
     fig.add_trace(go.Scatter(
         x=df_filial.index,
-        y=df_filial['acumulado_perc'],
+        y=df_filial['acumulado'],
         name='Acumulado (%)',
         yaxis='y2',
         mode='lines+markers',
@@ -120,46 +219,16 @@ if uploaded_file:
     st.plotly_chart(fig, use_container_width=True)
 
     # Geração do Excel
-    output = BytesIO()
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Relatório Consolidado"
-
-    def escrever_tabela_com_estilo(ws, df, titulo, linha_inicial):
-        azul = PatternFill(start_color="0070C0", end_color="0070C0", fill_type="solid")
-        fonte_branca = Font(color="FFFFFF", bold=True)
-        fonte_negrito = Font(bold=True)
-        borda = Border(
-            left=Side(style='thin'), right=Side(style='thin'),
-            top=Side(style='thin'), bottom=Side(style='thin')
-        )
-        alinhamento = Alignment(horizontal="center", vertical="center")
-
-        ws.merge_cells(start_row=linha_inicial, start_column=1, end_row=linha_inicial, end_column=df.shape[1])
-        cell_titulo = ws.cell(row=linha_inicial, column=1, value=titulo)
-        cell_titulo.font = fonte_negrito
-        linha = linha_inicial + 1
-
-        for r_idx, row in enumerate(dataframe_to_rows(df, index=False, header=True), start=linha):
-            for c_idx, value in enumerate(row, start=1):
-                cell = ws.cell(row=r_idx, column=c_idx, value=value)
-                cell.border = borda
-                cell.alignment = alinhamento
-                if r_idx == linha:
-                    cell.fill = azul
-                    cell.font = fonte_branca
-
-        return linha + len(df) + 1
-
-    linha_atual = 1
-    linha_atual = escrever_tabela_com_estilo(ws, cobertura, "Cobertura Média por Filial", linha_atual)
-    linha_atual = escrever_tabela_com_estilo(ws, resumo_valores, "Distribuição por Faixa (Valores Absolutos)", linha_atual)
-    linha_atual = escrever_tabela_com_estilo(ws, resumo_percentuais, "Distribuição por Faixa (Percentuais)", linha_atual)
-
-    wb.save(output)
+    with st.spinner("Gerando relatório Excel..."):
+        try:
+            dados_excel = relatorio_excel.result()
+        except Exception:
+            # Não mantém um Future com erro no cache: o próximo rerun gera o relatório de novo
+            iniciar_relatorio_excel.clear()
+            raise
     st.download_button(
         label="📥 Baixar Relatório Excel",
-        data=output.getvalue(),
+        data=dados_excel,
         file_name="relatorio_estoque_formatado.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
\ No newline at end of file